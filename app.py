@@ -4,16 +4,475 @@
 
 import os
 import json
+import time
+import asyncio
+import shelve
+import hashlib
+import argparse
+import itertools
+import orjson
+import ijson
+import tiktoken
+import httpx
+import numpy as np
 import openai
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
 # --------------------------------------------------------------
 # Load OpenAI API Token From the .env File
 # --------------------------------------------------------------
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# Keep connections alive and multiplex concurrent requests over HTTP/2
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+    timeout=httpx.Timeout(60.0)
+)
+# Every API call is retried by retry_transient_errors, so the SDK's own retries are
+# disabled to keep the two from stacking
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client,
+                     timeout=httpx.Timeout(60.0), max_retries=0)
+
+# Retry API calls on transient failures only, with randomized exponential backoff;
+# other errors are raised on the first attempt
+retry_transient_errors = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(min=1, max=60),
+    retry=retry_if_exception_type((APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)),
+    reraise=True
+)
+
+@retry_transient_errors
+async def call_with_retries(method, *args, **kwargs):
+    """
+    Call an API method of `client`, retrying transient errors.
+
+    Args:
+        method (callable): Coroutine method of `client` to call.
+        *args: Positional arguments passed to the method.
+        **kwargs: Keyword arguments passed to the method.
+
+    Returns:
+        The value returned by the method.
+    """
+    return await method(*args, **kwargs)
+
+# Cell types whose source is sent to the model for variation
+VARIABLE_ROLES = frozenset({'code', 'markdown', 'system', 'tools', 'user', 'assistant', 'tool_use', 'tool_output'})
+
+# Maximum number of cell requests allowed in flight at the same time
+MAX_CONCURRENT_REQUESTS = 10
+
+# Maximum number of cells and of source tokens packed into a single variation request.
+# A packed reply repeats every cell as escaped JSON, so large groups would be cut off.
+CELLS_PER_REQUEST = 5
+PACKED_REQUEST_MAX_TOKENS = 400
+
+# Minimum length in tokens of a shared prompt prefix for the API to cache it
+PREFIX_CACHE_MIN_TOKENS = 1024
+
+# Per-minute request and token budgets enforced on the client side
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200000
+
+# Location of the on-disk cache of model responses
+CACHE_PATH = 'llm_cache'
+
+# Location, embedding model and cosine similarity threshold of the semantic cache
+SEMANTIC_CACHE_PATH = 'semantic_cache'
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.95
+
+# Cell types whose variations may be reused for merely similar cells. Code is excluded,
+# since a near-identical code cell (e.g. one extra import) is not interchangeable.
+SEMANTIC_CACHE_ROLES = frozenset({'markdown'})
+
+# Number of semantic cache entries above which lookups use a FAISS index, if available
+FAISS_MIN_ENTRIES = 10000
+
+# Limits of a single embeddings request: number of inputs, total tokens and tokens per input
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_MAX_TOKENS = 300000
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+
+# Model and sampling parameters used for every variation request
+MODEL = "gpt-4o-mini"
+MAX_TOKENS = 150
+TEMPERATURE = 0
+
+# Parameters describing how every notebook cell should be varied
+VARIATION_OPTIONS = {
+    "language": "python",  # You can adjust or derive this value dynamically
+    "context": "This is part of a Jupyter notebook.",
+    "preserve_structure": True,
+    "include_documentation": True,
+    "target_audience": "general",
+    "length_constraint": 150
+}
+
+# Buffer size used when reading notebook files
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Number of cells read, varied and written together when streaming a notebook
+STREAM_WINDOW_CELLS = 100
+
+# Input file and polling interval (in seconds) used by the Batch API mode
+BATCH_INPUT_PATH = 'batch_input.jsonl'
+BATCH_POLL_INTERVAL = 30
+
+# --------------------------------------------------------------
+# Cache Model Responses on Disk
+# --------------------------------------------------------------
+
+class LLMCache:
+    """
+    Deterministic on-disk cache of model responses keyed by a SHA-256 hash of the request.
+
+    Only requests sampled with a temperature of 0 are cached, since other requests are
+    not expected to return the same response twice.
+    """
+
+    def __init__(self, path, ttl_seconds=86400):
+        """
+        Args:
+            path (str): Path of the shelve database used to store responses.
+            ttl_seconds (int, optional): Number of seconds a cached response stays valid (default is one day).
+        """
+        self.path = path
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self._db = None
+
+    def _open(self):
+        if self._db is None:
+            self._db = shelve.open(self.path)
+        return self._db
+
+    @staticmethod
+    def cache_key(model, prompt, temperature, max_tokens):
+        """
+        Build the cache key for a request.
+
+        Args:
+            model (str): Name of the model.
+            prompt (str or list): Prompt text or list of chat messages sent to the model.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum number of generated tokens.
+
+        Returns:
+            str or None: Hex digest of the SHA-256 hash of the request parameters,
+                         or None if the request is not deterministic and must not be cached.
+        """
+        if temperature > 0:
+            return None
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached response for `key`, or None if it is missing or expired.
+        """
+        if key is None:
+            return None
+        entry = self._open().get(key)
+        if entry is None:
+            return None
+        created_at, text = entry
+        if datetime.now() - created_at > self.ttl:
+            return None
+        return text
+
+    def set(self, key, text):
+        """
+        Store `text` as the response for `key`.
+        """
+        if key is None:
+            return
+        self._open()[key] = (datetime.now(), text)
+
+    def close(self):
+        """
+        Flush and close the underlying database.
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+cache = LLMCache(CACHE_PATH)
+
+# --------------------------------------------------------------
+# Cache Variations of Similar Cells by Embedding
+# --------------------------------------------------------------
+
+class SemanticCache:
+    """
+    On-disk cache returning the stored variation of the most similar previously seen cell.
+
+    Embeddings are kept unit-normalized in a contiguous float32 matrix, so the cosine
+    similarity of a batch of queries against every entry is a single matrix product.
+
+    The cache is stored with a fingerprint of the settings its variations were generated
+    with, and is discarded when loaded with a different fingerprint. Entries older than
+    the TTL are dropped on load.
+    """
+
+    def __init__(self, path, fingerprint, threshold=SIMILARITY_THRESHOLD, ttl_seconds=86400):
+        """
+        Args:
+            path (str): Path prefix of the `.npy` embeddings file and `.json` entries file.
+            fingerprint (str): Fingerprint of the settings the variations are generated with.
+            threshold (float, optional): Minimum cosine similarity for a lookup to hit.
+            ttl_seconds (int, optional): Number of seconds an entry stays valid (default is one day).
+        """
+        self.embeddings_path = f"{path}.npy"
+        self.entries_path = f"{path}.json"
+        self.fingerprint = fingerprint
+        self.threshold = threshold
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.embeddings = None
+        self.roles = []
+        self.variations = []
+        self.created_at = []
+        self._index = None
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.entries_path, 'rb') as f:
+                entries = orjson.loads(f.read())
+            if entries.get('fingerprint') != self.fingerprint:
+                print(f"Discarding semantic cache {self.entries_path} built with different settings")
+                return
+            embeddings = np.load(self.embeddings_path)
+            rows = len(entries['created_at'])
+            if (embeddings.ndim != 2 or embeddings.shape[0] != rows
+                    or len(entries['roles']) != rows or len(entries['variations']) != rows):
+                raise ValueError("embeddings and entries have different lengths")
+        except FileNotFoundError:
+            return
+        except (orjson.JSONDecodeError, ValueError, KeyError, TypeError, AttributeError, EOFError) as e:
+            # E.g., files left inconsistent by an interrupted save
+            print(f"Discarding unreadable semantic cache {self.entries_path}: {e}")
+            return
+
+        oldest = (datetime.now() - self.ttl).timestamp()
+        keep = [n for n, created_at in enumerate(entries['created_at']) if created_at >= oldest]
+        if not keep:
+            return
+        self.embeddings = np.ascontiguousarray(embeddings[keep], dtype=np.float32)
+        self.roles = [entries['roles'][n] for n in keep]
+        self.variations = [entries['variations'][n] for n in keep]
+        self.created_at = [entries['created_at'][n] for n in keep]
+
+    def lookup(self, embeddings, roles):
+        """
+        Find cached variations for a batch of cells.
+
+        Args:
+            embeddings (numpy.ndarray): Unit-normalized float32 embeddings, one row per cell.
+            roles (list): Role of each cell; only entries with the same role can match.
+
+        Returns:
+            list: Cached variation for each cell, or None where no entry is similar enough.
+        """
+        self._load()
+        if self.embeddings is None or len(embeddings) == 0:
+            return [None] * len(roles)
+
+        stored_roles = np.array(self.roles)
+
+        if faiss is not None and len(self.variations) >= FAISS_MIN_ENTRIES:
+            if self._index is None:
+                self._index = faiss.IndexFlatIP(self.embeddings.shape[1])
+                self._index.add(self.embeddings)
+            k = min(10, len(self.variations))
+            sims, ids = self._index.search(embeddings, k)
+            results = []
+            for row_sims, row_ids, role in zip(sims, ids, roles):
+                match = next((j for sim, j in zip(row_sims, row_ids)
+                              if sim >= self.threshold and stored_roles[j] == role), None)
+                results.append(self.variations[match] if match is not None else None)
+            return results
+
+        sims = embeddings @ self.embeddings.T
+        sims[np.array(roles)[:, None] != stored_roles[None, :]] = -1.0
+        best = sims.argmax(axis=1)
+        best_sims = sims[np.arange(len(best)), best]
+        return [self.variations[j] if sim >= self.threshold else None
+                for j, sim in zip(best, best_sims)]
+
+    def add(self, embeddings, roles, variations):
+        """
+        Add a batch of cells and their variations to the cache.
+
+        Args:
+            embeddings (numpy.ndarray): Unit-normalized float32 embeddings, one row per cell.
+            roles (list): Role of each cell.
+            variations (list): Variation generated for each cell.
+        """
+        if len(embeddings) == 0:
+            return
+        self._load()
+        if self.embeddings is None:
+            self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        else:
+            self.embeddings = np.vstack([self.embeddings, embeddings]).astype(np.float32, copy=False)
+        self.roles.extend(roles)
+        self.variations.extend(variations)
+        self.created_at.extend([datetime.now().timestamp()] * len(roles))
+        self._index = None
+
+    def save(self):
+        """
+        Write the cache to disk if it holds any entries.
+
+        Both files are written to temporary files first and then moved into place, so an
+        interrupted save leaves the previous cache intact.
+        """
+        if self.embeddings is None:
+            return
+        with open(f"{self.embeddings_path}.tmp", 'wb') as f:
+            np.save(f, self.embeddings)
+        with open(f"{self.entries_path}.tmp", 'wb') as f:
+            f.write(orjson.dumps({'fingerprint': self.fingerprint, 'roles': self.roles,
+                                  'variations': self.variations, 'created_at': self.created_at}))
+        os.replace(f"{self.embeddings_path}.tmp", self.embeddings_path)
+        os.replace(f"{self.entries_path}.tmp", self.entries_path)
+
+# --------------------------------------------------------------
+# Count Tokens
+# --------------------------------------------------------------
+
+# Loading the BPE ranks is slow, so the tokenizer is created once and shared.
+# Special tokens are counted as plain text, since cells may legitimately contain them.
+ENCODING = tiktoken.encoding_for_model(MODEL)
+
+def count_tokens(text):
+    """
+    Count the tokens of a text.
+
+    Args:
+        text (str): Text to tokenize.
+
+    Returns:
+        int: Number of tokens.
+    """
+    return len(ENCODING.encode(text, disallowed_special=()))
+
+def count_tokens_batch(texts):
+    """
+    Count the tokens of many texts at once, tokenizing them in parallel threads.
+
+    Args:
+        texts (list): Texts to tokenize.
+
+    Returns:
+        list: Number of tokens of each text.
+    """
+    batch = ENCODING.encode_batch(texts, num_threads=os.cpu_count() or 1, disallowed_special=())
+    return [len(tokens) for tokens in batch]
+
+# --------------------------------------------------------------
+# Limit the Request and Token Rate on the Client Side
+# --------------------------------------------------------------
+
+class RateLimiter:
+    """
+    Client-side limiter holding requests back before they would exceed the per-minute budgets.
+
+    The token cost of each request is estimated with tiktoken before it is admitted,
+    and the usage counters are corrected with the rate limit headers returned by the API.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        """
+        Args:
+            requests_per_minute (int): Maximum number of requests per minute.
+            tokens_per_minute (int): Maximum number of prompt and completion tokens per minute.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window_start = time.monotonic()
+        self.requests_used = 0
+        self.tokens_used = 0
+        self._lock = asyncio.Lock()
+
+    def estimate_tokens(self, messages, max_tokens):
+        """
+        Estimate the number of tokens a chat request may consume.
+
+        Args:
+            messages (list): Chat messages of the request.
+            max_tokens (int): Maximum number of generated tokens.
+
+        Returns:
+            int: Prompt tokens plus per-message overhead plus `max_tokens`.
+        """
+        # The shared system prompt is counted once at import rather than on every request
+        prompt_tokens = sum(4 + (SYSTEM_PROMPT_TOKENS if m['content'] == SYSTEM_PROMPT
+                                 else count_tokens(m['content']))
+                            for m in messages)
+        return prompt_tokens + max_tokens
+
+    async def acquire(self, tokens):
+        """
+        Wait until one more request consuming `tokens` fits within the current minute's budget.
+        """
+        while True:
+            async with self._lock:
+                elapsed = time.monotonic() - self.window_start
+                if elapsed >= 60:
+                    self.window_start = time.monotonic()
+                    self.requests_used = 0
+                    self.tokens_used = 0
+                    elapsed = 0
+
+                # A request larger than the whole budget is admitted alone in a fresh window
+                fits_tokens = (self.tokens_used + tokens <= self.tokens_per_minute
+                               or self.tokens_used == 0)
+                if self.requests_used + 1 <= self.requests_per_minute and fits_tokens:
+                    self.requests_used += 1
+                    self.tokens_used += tokens
+                    return
+
+                wait = 60 - elapsed
+
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """
+        Raise the usage counters to match the remaining budget reported by the API.
+
+        Args:
+            headers (Mapping): Response headers containing `x-ratelimit-remaining-*` values.
+        """
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        if remaining_requests is not None and remaining_requests.isdigit():
+            self.requests_used = max(self.requests_used,
+                                     self.requests_per_minute - int(remaining_requests))
+        if remaining_tokens is not None and remaining_tokens.isdigit():
+            self.tokens_used = max(self.tokens_used,
+                                   self.tokens_per_minute - int(remaining_tokens))
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
 
 # --------------------------------------------------------------
 # Function Descriptions for Function Calling
@@ -64,6 +523,181 @@ function_descriptions = [
     }
 ]
 
+# --------------------------------------------------------------
+# System Prompt Shared by All Variation Requests
+# --------------------------------------------------------------
+
+# The system prompt is identical for every cell and is sent as the first message,
+# so the API can reuse its cached prefix across requests. Prefix caching only applies
+# to prefixes of at least PREFIX_CACHE_MIN_TOKENS tokens, so the prompt carries the
+# parameter schema and worked examples in addition to the instructions.
+SYSTEM_PROMPT = f"""You are a helpful assistant that generates variations of messages while keeping their meaning and functionality the same.
+Each user message contains a single message taken from a Jupyter notebook, followed by the parameters describing how it should be varied.
+Vary the message while preserving its core elements and functionality, and include necessary documentation strings.
+
+Guidelines:
+- Code must remain valid in the given programming language and behave exactly as the original.
+- Keep identifiers, imports, function signatures and outputs that other cells may depend on.
+- Markdown must keep its headings, lists, links and fenced code blocks.
+- When "Preserve Structure" is True, keep the order and layout of the original elements.
+- When "Include Documentation" is True, add or rewrite docstrings and comments where appropriate.
+- Adapt the wording to the target audience and respect the length constraint if one is given.
+- Reply with the varied message only, without any introduction, explanation or surrounding quotes.
+- When several numbered messages are given, reply with a JSON object whose "variations" array holds one varied message per item, in the same order.
+
+The parameters in the user message follow this schema:
+{json.dumps(function_descriptions[0]['parameters'], indent=2)}
+
+Example 1 - a code message.
+User:
+code message:
+import pandas as pd
+
+df = pd.read_csv("prices.csv")
+df["change"] = df["close"].pct_change()
+print(df.head())
+
+Context: This is part of a Jupyter notebook.
+Programming Language: python
+Preserve Structure: True
+Target Audience: general
+Length Constraint: 150
+Include Documentation: True
+Assistant:
+import pandas as pd
+
+# Load the daily prices and compute the relative change between consecutive closes
+df = pd.read_csv("prices.csv")
+df["change"] = df["close"].pct_change()
+
+# Show the first rows to check the new column
+print(df.head())
+
+Example 2 - a markdown message.
+User:
+markdown message:
+## Plot the Results
+
+We use `matplotlib` to draw one line per currency. See the [documentation](https://matplotlib.org) for styling options.
+
+Context: This is part of a Jupyter notebook.
+Programming Language: python
+Preserve Structure: True
+Target Audience: general
+Length Constraint: 150
+Include Documentation: True
+Assistant:
+## Plot the Results
+
+Each currency is drawn as its own line with `matplotlib`. Styling options are described in the [documentation](https://matplotlib.org).
+
+Example 3 - several numbered messages.
+User:
+Return a JSON object with a "variations" array holding one variation per item, in the same order.
+
+[1] markdown message:
+**User**
+
+How do I sort a dictionary by value?
+
+[2] code message:
+scores = {{"ann": 3, "bob": 1}}
+ranked = sorted(scores.items(), key=lambda item: item[1])
+
+Context: This is part of a Jupyter notebook.
+Programming Language: python
+Preserve Structure: True
+Target Audience: general
+Length Constraint: 150
+Include Documentation: True
+Assistant:
+{{"variations": ["**User**\\n\\nWhat is the way to sort a dictionary by its values?", "scores = {{\\"ann\\": 3, \\"bob\\": 1}}\\n# Sort the (name, score) pairs by score, lowest first\\nranked = sorted(scores.items(), key=lambda item: item[1])"]}}
+
+Example 4 - an assistant message mixing prose and code.
+User:
+assistant message:
+**Assistant**
+
+You can fetch the data with `requests` and check the status code before parsing it:
+
+```python
+import requests
+
+response = requests.get("https://api.example.com/items", timeout=10)
+response.raise_for_status()
+items = response.json()
+```
+
+This raises an error for any 4xx or 5xx response instead of failing later while parsing.
+
+Context: This is part of a Jupyter notebook.
+Programming Language: python
+Preserve Structure: True
+Target Audience: beginners
+Length Constraint: 150
+Include Documentation: True
+Assistant:
+**Assistant**
+
+Use `requests` to download the data, and verify the status code before you parse the body:
+
+```python
+import requests
+
+# Request the items, giving up after 10 seconds
+response = requests.get("https://api.example.com/items", timeout=10)
+# Stop early with an error if the server returned a 4xx or 5xx status
+response.raise_for_status()
+items = response.json()
+```
+
+With this check, a failed request is reported right away rather than surfacing as a confusing parsing error later on.
+
+Notice in the examples that code keeps its imports, names and behaviour, markdown keeps its heading, inline code and link,
+and the wording changes without adding or removing information. Apply the same rules to every message you receive.
+"""
+
+SYSTEM_PROMPT_TOKENS = count_tokens(SYSTEM_PROMPT)
+
+if SYSTEM_PROMPT_TOKENS < PREFIX_CACHE_MIN_TOKENS:
+    print(f"Warning: the system prompt is shorter than {PREFIX_CACHE_MIN_TOKENS} tokens "
+          f"and will not be served from the API's prompt cache")
+
+# --------------------------------------------------------------
+# User Message Templates
+# --------------------------------------------------------------
+
+# Only the per-cell fields vary between requests, so the user messages are filled
+# from fixed templates rather than rebuilt around the shared text every time.
+VARIATION_PARAMETERS_TEMPLATE = """Context: {context}
+Programming Language: {language}
+Preserve Structure: {preserve_structure}
+Target Audience: {target_audience}
+Length Constraint: {length_constraint}
+Include Documentation: {include_documentation}"""
+
+USER_TEMPLATE = "{role} message:\n{message}\n\n" + VARIATION_PARAMETERS_TEMPLATE
+
+PACKED_USER_TEMPLATE = ('Return a JSON object with a "variations" array holding one variation per item, '
+                        'in the same order.\n\n{numbered}\n\n' + VARIATION_PARAMETERS_TEMPLATE)
+
+# --------------------------------------------------------------
+# Create the Semantic Cache for the Current Settings
+# --------------------------------------------------------------
+
+# Cached variations are only valid for the model, prompts and options they were generated
+# with, and embeddings from another embedding model cannot be compared with new ones
+semantic_cache = SemanticCache(SEMANTIC_CACHE_PATH, fingerprint=hashlib.sha256(orjson.dumps({
+    "model": MODEL,
+    "max_tokens": MAX_TOKENS,
+    "temperature": TEMPERATURE,
+    "embedding_model": EMBEDDING_MODEL,
+    "system_prompt": SYSTEM_PROMPT,
+    "user_template": USER_TEMPLATE,
+    "packed_user_template": PACKED_USER_TEMPLATE,
+    "variation_options": VARIATION_OPTIONS
+}, option=orjson.OPT_SORT_KEYS)).hexdigest())
+
 # --------------------------------------------------------------
 # Load and Process Notebooks
 # --------------------------------------------------------------
@@ -80,12 +714,12 @@ def load_notebook(notebook_path):
                       None if file not found or JSON decoding error occurs.
     """
     try:
-        with open(notebook_path, 'r') as f:
-            return json.load(f)
+        with open(notebook_path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         print(f"Error: File not found at {notebook_path}")
         return None
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON from {notebook_path}: {e}")
         return None
     
@@ -102,12 +736,115 @@ def extract_cells(notebook):
     """
     return notebook['cells'] if notebook else []
 
+def iter_cells(notebook_path):
+    """
+    Iterate over the cells of a Jupyter notebook without loading the whole file.
+
+    Args:
+        notebook_path (str): Path to the JSON file containing the notebook.
+
+    Yields:
+        dict: Each cell of the notebook, in order.
+    """
+    with open(notebook_path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        yield from ijson.items(f, 'cells.item', use_float=True)
+
+def load_notebook_entries(notebook_path):
+    """
+    Load the top-level entries of a Jupyter notebook other than its cells.
+
+    The cells are skipped while parsing, so memory use does not depend on their size.
+
+    Args:
+        notebook_path (str): Path to the JSON file containing the notebook.
+
+    Returns:
+        dict: Top-level entries (e.g., metadata, nbformat) in file order, without 'cells'.
+    """
+    entries = {}
+    key = None
+    builder = None
+    with open(notebook_path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == '' and event in ('map_key', 'end_map'):
+                if builder is not None:
+                    entries[key] = builder.value
+                key = value
+                builder = ijson.ObjectBuilder() if key != 'cells' else None
+            elif builder is not None:
+                builder.event(event, value)
+    return entries
+
+def dump_indented(value, depth):
+    """
+    Serialize a value with two-space indentation, nested `depth` levels deep.
+
+    Args:
+        value: JSON-serializable value.
+        depth (int): Nesting level at which the value is written.
+
+    Returns:
+        bytes: The serialized value. Raw newlines only occur between tokens,
+               so re-indenting them cannot alter string values.
+    """
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2).replace(b'\n', b'\n' + b'  ' * depth)
+
+def write_notebook(notebook, f):
+    """
+    Write a notebook as indented JSON, serializing one cell at a time.
+
+    The output is identical to dumping the whole notebook with orjson's two-space
+    indentation, but only a single cell is held as serialized bytes at any time.
+
+    Args:
+        notebook (dict): The notebook to write.
+        f (file): File object opened in binary write mode.
+
+    Returns:
+        None
+    """
+    f.write(b'{')
+    for n, (key, value) in enumerate(notebook.items()):
+        f.write(b',\n  ' if n else b'\n  ')
+        f.write(orjson.dumps(key) + b': ')
+        if key != 'cells' or not value:
+            f.write(dump_indented(value, 1))
+            continue
+
+        f.write(b'[')
+        for m, cell in enumerate(value):
+            f.write(b',\n    ' if m else b'\n    ')
+            f.write(dump_indented(cell, 2))
+        f.write(b'\n  ]')
+    f.write(b'\n}\n' if notebook else b'}\n')
+
+def apply_variations(cells, variations):
+    """
+    Replace the source of each variable cell with its variation.
+
+    Args:
+        cells (list): List of dictionaries representing notebook cells, modified in place.
+        variations (list): List of dictionaries containing original and varied cells, as returned
+                           by process_cells_with_function_call or process_cells_with_batch.
+
+    Returns:
+        None
+    """
+    for cell, varied in zip(cells, variations):
+        if cell['cell_type'] in VARIABLE_ROLES:
+            if varied['variation'] is not varied['original']:
+                cell['source'] = varied['variation'].splitlines(keepends=True)
+            else:
+                # Unchanged cells keep their original list of lines without copying it
+                cell['source'] = varied['source_list']
+
 def save_variations(variations, output_path, original_notebook):
     """
     Save variations of notebook cells to a new JSON file.
 
     Args:
-        variations (list): List of dictionaries containing original and varied cells.
+        variations (list): List of dictionaries containing original and varied cells, as returned
+                           by process_cells_with_function_call or process_cells_with_batch.
         output_path (str): Path to save the varied notebook JSON file.
         original_notebook (dict): Original notebook loaded as a Python dictionary.
 
@@ -115,12 +852,9 @@ def save_variations(variations, output_path, original_notebook):
         None
     """
     try:
-        for i, cell in enumerate(original_notebook['cells']):
-            cell_type = cell['cell_type']
-            if cell_type in ['code', 'markdown', 'system', 'tools', 'user', 'assistant', 'tool_use', 'tool_output']:
-                cell['source'] = variations[i]['variation'].splitlines(keepends=True)
-        with open(output_path, 'w') as f:
-            json.dump(original_notebook, f, indent=4)
+        apply_variations(original_notebook['cells'], variations)
+        with open(output_path, 'wb') as f:
+            write_notebook(original_notebook, f)
         print(f"Variations saved to {output_path}")
     except IOError as e:
         print(f"Error saving variations to {output_path}: {e}")
@@ -129,11 +863,11 @@ def save_variations(variations, output_path, original_notebook):
 # Generate Variations with Function Calling
 # --------------------------------------------------------------
 
-def generate_variation_with_function_call(message, role, language, context,
-                                          preserve_structure, include_documentation,
-                                          target_audience="general", length_constraint=None):
+def build_variation_messages(message, role, language, context,
+                             preserve_structure, include_documentation,
+                             target_audience="general", length_constraint=None):
     """
-    Generate a variation of a given message using the OpenAI GPT-4 model.
+    Build the chat messages requesting a variation of a given message.
 
     Args:
         message (str): The message to be varied.
@@ -146,85 +880,606 @@ def generate_variation_with_function_call(message, role, language, context,
         length_constraint (int, optional): Any length constraints for the variation.
 
     Returns:
-        str: Generated variation of the message as a string.
+        list: Chat messages, starting with the shared system prompt.
     """
-    
-    
-    prompt = f"""
-    You are a helpful assistant that generates variations of messages while keeping their meaning and functionality the same. 
-    Please vary the following {role} message while preserving its core elements, functionality, and including necessary documentation strings:
-    {message}
-    
-    Context: {context}
-    Programming Language: {language}
-    Preserve Structure: {preserve_structure}
-    Target Audience: {target_audience}
-    Length Constraint: {length_constraint}
-    Include Documentation: {include_documentation}
+    user_message = USER_TEMPLATE.format_map(locals())
+
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_message}
+    ]
+
+def build_packed_variation_messages(items, language, context,
+                                    preserve_structure, include_documentation,
+                                    target_audience="general", length_constraint=None):
     """
+    Build the chat messages requesting variations of several messages at once.
 
-    try:
-        completion = openai.completions.create(
-            model="gpt-4",
-            prompt=prompt,
-            max_tokens=150,
-            temperature=0.7,
+    Args:
+        items (list): List of (role, message) tuples to be varied.
+        language (str): The programming language of the code (if applicable).
+        context (str): Additional context or description about the messages or code.
+        preserve_structure (bool): Whether to preserve the structural elements of the messages.
+        include_documentation (bool): Whether to include documentation strings.
+        target_audience (str, optional): The target audience for the messages (default is "general").
+        length_constraint (int, optional): Any length constraints for each variation.
+
+    Returns:
+        list: Chat messages, starting with the shared system prompt.
+    """
+    numbered = "\n\n".join(f"[{n}] {role} message:\n{message}"
+                            for n, (role, message) in enumerate(items, start=1))
+
+    user_message = PACKED_USER_TEMPLATE.format_map(locals())
+
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_message}
+    ]
+
+async def request_chat_completion(messages, max_tokens=MAX_TOKENS, response_format=None, parse=None):
+    """
+    Send a chat completion request, serving it from the response cache when possible.
+
+    Args:
+        messages (list): Chat messages to send to the model.
+        max_tokens (int, optional): Maximum number of generated tokens.
+        response_format (dict, optional): Response format requested from the model.
+        parse (callable, optional): Converts the reply text into the returned value, or returns
+                                    None to reject it. Only accepted replies are cached.
+
+    Returns:
+        str or None: Content of the first choice (converted by `parse` if given), or None if
+                     the request failed after retrying transient errors, returned nothing,
+                     was truncated at `max_tokens`, or the reply was rejected.
+    """
+    key = LLMCache.cache_key(MODEL, messages, TEMPERATURE, max_tokens)
+    cached = cache.get(key)
+    if cached is not None:
+        result = parse(cached) if parse is not None else cached
+        if result is not None:
+            return result
+
+    params = {}
+    if response_format is not None:
+        params['response_format'] = response_format
+
+    @retry_transient_errors
+    async def send():
+        await rate_limiter.acquire(rate_limiter.estimate_tokens(messages, max_tokens))
+        response = await client.chat.completions.with_raw_response.create(
+            model=MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=TEMPERATURE,
             n=1,
-            stop=None
+            stop=None,
+            stream=True,
+            **params
         )
+        rate_limiter.update_from_headers(response.headers)
 
-        if 'choices' in completion and len(completion['choices']) > 0:
-            return completion.choices[0].text.strip()
+        # Consume the reply as it is generated, yielding to other requests between chunks
+        chunks = []
+        finish_reason = None
+        async for event in response.parse():
+            if not event.choices:
+                continue
+            if event.choices[0].delta.content:
+                chunks.append(event.choices[0].delta.content)
+            if event.choices[0].finish_reason:
+                finish_reason = event.choices[0].finish_reason
+        return ''.join(chunks).strip(), finish_reason
 
-        return message
-
-    except openai.Error as e:
+    try:
+        text, finish_reason = await send()
+    except openai.OpenAIError as e:
         print(f"OpenAI API error: {e}")
-        return message
+        return None
 
-def process_cells_with_function_call(cells):
+    # A reply cut off at max_tokens is incomplete (e.g., half a code cell) and must not be cached
+    if finish_reason == "length":
+        print(f"Reply truncated at {max_tokens} tokens, discarding it")
+        return None
+
+    if not text:
+        return None
+
+    result = parse(text) if parse is not None else text
+    if result is not None:
+        cache.set(key, text)
+    return result
+
+async def generate_variation_with_function_call(message, role, language, context,
+                                                preserve_structure, include_documentation,
+                                                target_audience="general", length_constraint=None):
     """
-    Process each cell in a list of notebook cells, generating variations where applicable.
+    Generate a variation of a given message using the OpenAI gpt-4o-mini chat model.
+
+    Args:
+        message (str): The message to be varied.
+        role (str): The role of the message (e.g., code, markdown).
+        language (str): The programming language of the code (if applicable).
+        context (str): Additional context or description about the message or code.
+        preserve_structure (bool): Whether to preserve the structural elements of the message.
+        include_documentation (bool): Whether to include documentation strings.
+        target_audience (str, optional): The target audience for the message (default is "general").
+        length_constraint (int, optional): Any length constraints for the variation.
+
+    Returns:
+        str: Generated variation of the message as a string.
+    """
+    messages = build_variation_messages(message, role, language, context,
+                                        preserve_structure, include_documentation,
+                                        target_audience, length_constraint)
+
+    text = await request_chat_completion(messages)
+    return text if text is not None else message
+
+async def generate_packed_variations(items, language, context,
+                                     preserve_structure, include_documentation,
+                                     target_audience="general", length_constraint=None):
+    """
+    Generate variations of several messages with a single request.
+
+    Args:
+        items (list): List of (role, message) tuples to be varied.
+        language (str): The programming language of the code (if applicable).
+        context (str): Additional context or description about the messages or code.
+        preserve_structure (bool): Whether to preserve the structural elements of the messages.
+        include_documentation (bool): Whether to include documentation strings.
+        target_audience (str, optional): The target audience for the messages (default is "general").
+        length_constraint (int, optional): Any length constraints for each variation.
+
+    Returns:
+        list or None: Generated variations, one string per item, or None if the request
+                      failed or the reply was truncated or could not be parsed.
+    """
+    messages = build_packed_variation_messages(items, language, context,
+                                               preserve_structure, include_documentation,
+                                               target_audience, length_constraint)
+
+    def parse_variations(text):
+        try:
+            variations = orjson.loads(text)['variations']
+        except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+            print(f"Error parsing packed variations: {e}")
+            return None
+
+        if (not isinstance(variations, list) or len(variations) != len(items)
+                or not all(isinstance(v, str) for v in variations)):
+            print(f"Expected {len(items)} packed variations, got: {variations!r}")
+            return None
+
+        return [v.strip() for v in variations]
+
+    # The reply repeats every message, escaped and with added documentation, so the
+    # budget grows with the size of the messages on top of MAX_TOKENS per item
+    source_tokens = sum(count_tokens_batch([message for _, message in items]))
+    return await request_chat_completion(messages, max_tokens=2 * source_tokens + MAX_TOKENS * len(items),
+                                         response_format={"type": "json_object"},
+                                         parse=parse_variations)
+
+def split_embedding_batches(token_counts):
+    """
+    Split inputs into consecutive sub-batches that each fit in one embeddings request.
+
+    Args:
+        token_counts (list): Number of tokens of each input.
+
+    Returns:
+        list: List of (start, end) index ranges, one per sub-batch.
+    """
+    batches = []
+    start = 0
+    tokens = 0
+    for i, count in enumerate(token_counts):
+        if i > start and (i - start >= EMBEDDING_MAX_INPUTS or tokens + count > EMBEDDING_MAX_TOKENS):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+def split_packed_groups(token_counts, cells_per_request=CELLS_PER_REQUEST,
+                        max_tokens=PACKED_REQUEST_MAX_TOKENS):
+    """
+    Split cells into consecutive groups that are each packed into one variation request.
+
+    Args:
+        token_counts (list): Number of source tokens of each cell.
+        cells_per_request (int, optional): Maximum number of cells in a group.
+        max_tokens (int, optional): Maximum number of source tokens in a group. A cell
+                                    larger than this is placed in a group of its own.
+
+    Returns:
+        list: List of (start, end) index ranges, one per group.
+    """
+    groups = []
+    start = 0
+    tokens = 0
+    for i, count in enumerate(token_counts):
+        if i > start and (i - start >= cells_per_request or tokens + count > max_tokens):
+            groups.append((start, i))
+            start = i
+            tokens = 0
+        tokens += count
+    if start < len(token_counts):
+        groups.append((start, len(token_counts)))
+    return groups
+
+def prepare_varied_cells(cells):
+    """
+    Build the variation entries of a list of notebook cells, grouping identical eligible cells.
+
+    Eligible cells with the same role and source share a single source string, so that a
+    variation only has to be generated once for all of them.
 
     Args:
         cells (list): List of dictionaries representing notebook cells.
 
     Returns:
-        list: List of dictionaries containing original and varied cells.
+        tuple: The list of variation entries, one per cell, and a dict mapping each distinct
+               (role, source) of an eligible cell to the indices of all cells sharing it.
     """
     varied_cells = []
+    occurrences = {}
 
-    for cell in cells:
+    for i, cell in enumerate(cells):
         role = cell['cell_type']
+        if role not in VARIABLE_ROLES:
+            varied_cells.append({'role': role, 'source_list': cell['source'],
+                                 'original': None, 'variation': None})  # No change for other cells
+            continue
+
         source = ''.join(cell['source'])
-        
-        if role in ['code', 'markdown', 'system', 'tools', 'user', 'assistant', 'tool_use', 'tool_output']:
-            variation = generate_variation_with_function_call(
-                message=source,
-                role=role,
-                language="python",  # You can adjust or derive this value dynamically
-                context="This is part of a Jupyter notebook.",
-                preserve_structure=True,
-                include_documentation=True,
-                target_audience="general",
-                length_constraint=150
+        indices = occurrences.setdefault((role, source), [])
+        if indices:
+            source = varied_cells[indices[0]]['original']
+        indices.append(i)
+        varied_cells.append({'role': role, 'source_list': cell['source'],
+                             'original': source, 'variation': source})
+
+    return varied_cells, occurrences
+
+def share_variations(varied_cells, occurrences):
+    """
+    Copy the variation of the first cell of each group of identical cells to the other cells.
+
+    Args:
+        varied_cells (list): Variation entries as returned by prepare_varied_cells.
+        occurrences (dict): Groups of identical cells as returned by prepare_varied_cells.
+
+    Returns:
+        None
+    """
+    for first, *others in occurrences.values():
+        for i in others:
+            varied_cells[i]['variation'] = varied_cells[first]['variation']
+
+async def embed_texts(texts, token_counts):
+    """
+    Embed texts with as few embeddings requests as the API limits allow.
+
+    All texts are sent in a single request unless they exceed EMBEDDING_MAX_INPUTS inputs
+    or EMBEDDING_MAX_TOKENS tokens, in which case the sub-batches are sent concurrently.
+
+    Args:
+        texts (list): Non-empty strings to embed, each within EMBEDDING_MAX_INPUT_TOKENS tokens.
+        token_counts (list): Number of tokens of each text.
+
+    Returns:
+        numpy.ndarray or None: Unit-normalized float32 embeddings, one row per text,
+                               or None if a request failed.
+    """
+    @retry_transient_errors
+    async def embed_batch(start, end):
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=texts[start:end])
+        return [d.embedding for d in response.data]
+
+    try:
+        results = await asyncio.gather(*(embed_batch(start, end)
+                                         for start, end in split_embedding_batches(token_counts)))
+    except openai.OpenAIError as e:
+        print(f"OpenAI API error: {e}")
+        return None
+
+    embeddings = np.array([e for batch in results for e in batch], dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+async def process_cells_with_function_call(cells, max_concurrent=MAX_CONCURRENT_REQUESTS,
+                                           cells_per_request=CELLS_PER_REQUEST):
+    """
+    Process each cell in a list of notebook cells, generating variations where applicable.
+
+    Identical eligible cells are only varied once. Markdown cells similar enough to a
+    previously varied markdown cell reuse its variation from the semantic cache. The
+    remaining cells are packed into groups of at most `cells_per_request` cells and
+    PACKED_REQUEST_MAX_TOKENS source tokens that are each sent as one request; the cells
+    of a group whose reply is rejected are then requested one at a time. Requests for all
+    groups are issued concurrently, with at most `max_concurrent` of them in flight at any time.
+
+    Args:
+        cells (list): List of dictionaries representing notebook cells.
+        max_concurrent (int, optional): Maximum number of concurrent API requests.
+        cells_per_request (int, optional): Maximum number of cells packed into one request.
+
+    Returns:
+        list: List of dictionaries containing original and varied cells, in the original cell order.
+              Each entry holds the cell 'role', its original 'source_list', and the joined
+              'original' and 'variation' strings (None for cells that are not varied).
+    """
+    varied_cells, occurrences = prepare_varied_cells(cells)
+    eligible = [indices[0] for indices in occurrences.values()]
+
+    # Only cells of the semantic cache roles are looked up; empty and over-long cells cannot be embedded
+    candidates = [i for i in eligible if varied_cells[i]['role'] in SEMANTIC_CACHE_ROLES]
+    token_counts = dict(zip(candidates, count_tokens_batch([varied_cells[i]['original'] for i in candidates])))
+    embedded = [i for i in candidates
+                if varied_cells[i]['original'].strip() and token_counts[i] <= EMBEDDING_MAX_INPUT_TOKENS]
+    embeddings = None
+    if embedded:
+        embeddings = await embed_texts([varied_cells[i]['original'] for i in embedded],
+                                       [token_counts[i] for i in embedded])
+
+    if embeddings is not None:
+        hits = semantic_cache.lookup(embeddings, [varied_cells[i]['role'] for i in embedded])
+        for i, hit in zip(embedded, hits):
+            if hit is not None:
+                varied_cells[i]['variation'] = hit
+        pending = [i for i in eligible if varied_cells[i]['variation'] is varied_cells[i]['original']]
+    else:
+        pending = eligible
+
+    sem = asyncio.Semaphore(max_concurrent)
+
+    async def process_cell(i):
+        async with sem:
+            varied_cells[i]['variation'] = await generate_variation_with_function_call(
+                message=varied_cells[i]['original'],
+                role=varied_cells[i]['role'],
+                **VARIATION_OPTIONS
             )
-            varied_cells.append({'role': role, 'original': source, 'variation': variation})
-        else:
-            varied_cells.append({'role': role, 'original': source, 'variation': source})  # No change for other cells
 
+    async def process_group(indices):
+        if len(indices) == 1:
+            await process_cell(indices[0])
+            return
+
+        items = [(varied_cells[i]['role'], varied_cells[i]['original']) for i in indices]
+        async with sem:
+            variations = await generate_packed_variations(items, **VARIATION_OPTIONS)
+        if variations is None:
+            # Fall back to one request per cell, so that a single long or awkward cell
+            # does not leave the other cells of its group unchanged
+            await asyncio.gather(*(process_cell(i) for i in indices))
+            return
+        for i, variation in zip(indices, variations):
+            varied_cells[i]['variation'] = variation
+
+    pending_tokens = count_tokens_batch([varied_cells[i]['original'] for i in pending])
+    groups = [pending[start:end]
+              for start, end in split_packed_groups(pending_tokens, cells_per_request)]
+    await asyncio.gather(*(process_group(group) for group in groups))
+
+    if embeddings is not None:
+        # Only cache cells that were freshly and successfully varied in this run
+        pending = set(pending)
+        new = [n for n, i in enumerate(embedded)
+               if i in pending and varied_cells[i]['variation'] is not varied_cells[i]['original']]
+        semantic_cache.add(embeddings[new],
+                           [varied_cells[embedded[n]]['role'] for n in new],
+                           [varied_cells[embedded[n]]['variation'] for n in new])
+
+    share_variations(varied_cells, occurrences)
+    return varied_cells
+
+# --------------------------------------------------------------
+# Generate Variations with the Batch API
+# --------------------------------------------------------------
+
+async def run_batch(requests, input_path=BATCH_INPUT_PATH, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Submit chat completion requests as one batch and wait for their results.
+
+    Args:
+        requests (list): Batch request objects, each with a unique `custom_id`.
+        input_path (str, optional): Path of the JSONL file holding the batch requests.
+        poll_interval (int, optional): Number of seconds to wait between status checks.
+
+    Returns:
+        dict: Content of the first choice for each successful request, keyed by `custom_id`.
+              Failed or truncated requests and API errors are reported and left out.
+    """
+    with open(input_path, 'w') as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+    results = {}
+    try:
+        # The file is uploaded from memory, so that a retried upload sends it again in full
+        with open(input_path, 'rb') as f:
+            upload = (os.path.basename(input_path), f.read())
+        batch_file = await call_with_retries(client.files.create, file=upload, purpose="batch")
+        batch = await call_with_retries(
+            client.batches.create,
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await call_with_retries(client.batches.retrieve, batch.id)
+
+        if batch.status != "completed":
+            print(f"Batch {batch.id} finished with status {batch.status}")
+
+        # Successful requests are in the output file, failed ones in the error file. Expired
+        # and cancelled batches still provide them for the requests that finished (and were billed).
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await call_with_retries(client.files.content, file_id)
+            for line in content.content.splitlines():
+                if not line.strip():
+                    continue
+                result = orjson.loads(line)
+                response = result.get('response')
+                if not response or response['status_code'] != 200:
+                    print(f"Batch request {result['custom_id']} failed: "
+                          f"{result.get('error') or (response or {}).get('body')}")
+                    continue
+
+                choices = response['body']['choices']
+                if choices and choices[0].get('finish_reason') == "length":
+                    # A reply cut off at max_tokens is incomplete and must not be used or cached
+                    print(f"Batch request {result['custom_id']} failed: reply truncated at max_tokens")
+                    continue
+                if choices and choices[0]['message']['content']:
+                    results[result['custom_id']] = choices[0]['message']['content'].strip()
+
+    except openai.OpenAIError as e:
+        print(f"OpenAI API error: {e}")
+
+    return results
+
+async def process_cells_with_batch(cells, input_path=BATCH_INPUT_PATH, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Process each cell in a list of notebook cells through the OpenAI Batch API.
+
+    All distinct uncached eligible cells are written to a JSONL file, submitted as one batch
+    and mapped back to their cells by `custom_id` once the batch has finished.
+    Cells whose request failed keep their original source.
+
+    Each batch request carries a single cell, whereas process_cells_with_function_call packs
+    several cells per request, so the two modes rarely reuse each other's cached responses.
+
+    Args:
+        cells (list): List of dictionaries representing notebook cells.
+        input_path (str, optional): Path of the JSONL file holding the batch requests.
+        poll_interval (int, optional): Number of seconds to wait between status checks.
+
+    Returns:
+        list: List of dictionaries containing original and varied cells, in the original cell order.
+    """
+    varied_cells, occurrences = prepare_varied_cells(cells)
+    requests = []
+    keys = {}
+
+    for (role, source), indices in occurrences.items():
+        i = indices[0]
+        messages = build_variation_messages(message=source, role=role, **VARIATION_OPTIONS)
+        key = LLMCache.cache_key(MODEL, messages, TEMPERATURE, MAX_TOKENS)
+        cached = cache.get(key)
+        if cached is not None:
+            varied_cells[i]['variation'] = cached
+            continue
+
+        custom_id = f"cell-{i}"
+        keys[custom_id] = (i, key)
+        requests.append({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": MODEL,
+                "messages": messages,
+                "max_tokens": MAX_TOKENS,
+                "temperature": TEMPERATURE
+            }
+        })
+
+    results = await run_batch(requests, input_path, poll_interval) if requests else {}
+    for custom_id, text in results.items():
+        if custom_id in keys:
+            i, key = keys[custom_id]
+            cache.set(key, text)
+            varied_cells[i]['variation'] = text
+
+    share_variations(varied_cells, occurrences)
     return varied_cells
 
+# --------------------------------------------------------------
+# Process Large Notebooks as a Stream
+# --------------------------------------------------------------
+
+async def process_notebook_streaming(input_path, output_path, window_size=STREAM_WINDOW_CELLS):
+    """
+    Read, vary and write a notebook a window of cells at a time.
+
+    Cells are parsed incrementally from the input file, varied `window_size` at a time with
+    process_cells_with_function_call, and written to the output file as soon as their window
+    is done, so memory use is bounded by the window rather than the notebook size. Identical
+    cells are only grouped within a window. The output has the same layout as save_variations,
+    with the cells written before the other top-level entries.
+
+    Args:
+        input_path (str): Path to the JSON file containing the notebook.
+        output_path (str): Path to save the varied notebook JSON file.
+        window_size (int, optional): Number of cells processed together.
+
+    Returns:
+        None
+    """
+    try:
+        entries = load_notebook_entries(input_path)
+    except FileNotFoundError:
+        print(f"Error: File not found at {input_path}")
+        return
+    except ijson.JSONError as e:
+        print(f"Error decoding JSON from {input_path}: {e}")
+        return
+
+    # Write to a temporary file that replaces the output only once it is complete,
+    # so that a failure part-way through does not leave a truncated notebook behind
+    temp_path = f"{output_path}.tmp"
+    try:
+        cells = iter_cells(input_path)
+        with open(temp_path, 'wb') as f:
+            f.write(b'{\n  "cells": [')
+            written = 0
+            while True:
+                window = list(itertools.islice(cells, window_size))
+                if not window:
+                    break
+                variations = await process_cells_with_function_call(window)
+                apply_variations(window, variations)
+                for cell in window:
+                    f.write(b',\n    ' if written else b'\n    ')
+                    f.write(dump_indented(cell, 2))
+                    written += 1
+            f.write(b'\n  ]' if written else b']')
+            for key, value in entries.items():
+                f.write(b',\n  ' + orjson.dumps(key) + b': ' + dump_indented(value, 1))
+            f.write(b'\n}\n')
+        os.replace(temp_path, output_path)
+        print(f"Variations saved to {output_path}")
+    except ijson.JSONError as e:
+        print(f"Error decoding JSON from {input_path}: {e}")
+    except IOError as e:
+        print(f"Error saving variations to {output_path}: {e}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 # --------------------------------------------------------------
 # Main Function with Function Calling
 # --------------------------------------------------------------
 
-def main_with_function_call():
+def main_with_function_call(use_batch=False, use_stream=False):
     """
     Main function to orchestrate the process of loading, processing, generating variations, and saving a Jupyter notebook.
 
     Args:
-        None
+        use_batch (bool, optional): Whether to generate the variations through the Batch API
+                                    instead of concurrent chat requests.
+        use_stream (bool, optional): Whether to stream the notebook through the pipeline a window
+                                     of cells at a time instead of loading it whole.
 
     Returns:
         None
@@ -232,11 +1487,33 @@ def main_with_function_call():
     input_path = 'notebook/Sample1.ipynb'
     output_path = 'varied/notebook.json'
 
+    if use_stream:
+        try:
+            asyncio.run(process_notebook_streaming(input_path, output_path))
+        finally:
+            cache.close()
+            semantic_cache.save()
+        return
+
     notebook = load_notebook(input_path)
     cells = extract_cells(notebook)
-    variations = process_cells_with_function_call(cells)
+    try:
+        if use_batch:
+            variations = asyncio.run(process_cells_with_batch(cells))
+        else:
+            variations = asyncio.run(process_cells_with_function_call(cells))
+    finally:
+        cache.close()
+        semantic_cache.save()
     save_variations(variations, output_path, notebook)
     print(f"Variations saved to {output_path}")
 
 if __name__ == '__main__':
-    main_with_function_call()
+    parser = argparse.ArgumentParser(description="Generate variations of the cells of a Jupyter notebook.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--batch', action='store_true',
+                      help="Submit all cells through the OpenAI Batch API (cheaper, completes within 24h).")
+    mode.add_argument('--stream', action='store_true',
+                      help="Stream the notebook a window of cells at a time (for very large notebooks).")
+    args = parser.parse_args()
+    main_with_function_call(use_batch=args.batch, use_stream=args.stream)